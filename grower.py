@@ -1,7 +1,6 @@
 import logger
 import watering
-from time import sleep
-from threading import Thread
+from threading import Event, Thread
 
 # Raspberry lib
 import RPi.GPIO as GPIO
@@ -9,16 +8,29 @@ import RPi.GPIO as GPIO
 
 if __name__ == "__main__":
 
+    # Daemon, so a stuck watering loop never keeps the process alive, the
+    # normal shutdown still goes through stopEvent and join() below
+    stopEvent = Event()
+    wateringThread = Thread(target=watering.run, kwargs={ 'logger': logger, 'stopEvent': stopEvent }, daemon=True)
+
     try:
         GPIO.setmode(GPIO.BOARD)
 
-        wateringThread = Thread(target=watering.run(logger=logger))
-        wateringThread.daemon = True
         wateringThread.start()
 
-        while True:
-            sleep(0.1)
+        # Block until the watering loop exits
+        wateringThread.join()
+
+    except KeyboardInterrupt:
+        pass
 
     except Exception as e:
-        GPIO.cleanup()
         logger.exception(e)
+
+    finally:
+        # Stop watering loop before releasing GPIO
+        stopEvent.set()
+        if wateringThread.is_alive():
+            wateringThread.join()
+
+        GPIO.cleanup()
@@ -17,28 +17,40 @@ and creates a unique Logger object using the QueueHandler:
 
 To use, simply 'import logger' and log away!
 
-NOTE: Configuration can be changed at runtime by updating the 'logging.yml' file
+NOTE: Configuration can be changed at runtime by updating the 'logging.yml' file.
+If it starts with a '# content-version: <version>' line, it is only parsed again
+when that version changes, so bump it on every edit
 """
 
 # Log config file location and global logger name
 # Change if need
 DEFAULTS = {
     'CONFIG_FILE': 'logger/logger.yml',
-    'LOGGER_NAME': 'root'
+    'LOGGER_NAME': 'root',
+    'CHECK_INTERVAL': 2.0, # secs between config file checks
+    'FLUSH_INTERVAL': 0.5, # secs records may stay buffered before written
+    'BUFFER_SIZE': 64 * 1024, # bytes
+    'QUEUE_SIZE': 4096 # records waiting to be written
 }
 
 
-from yaml import load
-from queue import Queue
-from hashlib import md5
-from threading import RLock
-from logging import FileHandler, Formatter, getLogger
+from os import stat
+from yaml import YAMLError, load
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+from queue import Empty
+from collections import deque
+from time import monotonic, sleep
+from threading import Event, RLock, Thread
+from logging import FileHandler, Formatter, getLogger, makeLogRecord
 from logging.handlers import QueueHandler, QueueListener
 
 
 __all__ = [ 'critical', 'error', 'exception', 'warning', 'debug',
-            'info', 'log',  'CRITICAL', 'FATAL', 'ERROR', 'WARNING',
-            'WARN', 'INFO', 'DEBUG' ]
+            'info', 'log', 'isEnabledFor', 'CRITICAL', 'FATAL', 'ERROR',
+            'WARNING', 'WARN', 'INFO', 'DEBUG' ]
 
 
 #---------------------------------------------------------------------------
@@ -96,86 +108,251 @@ def _releaseLock():
 #---------------------------------------------------------------------------
 
 def _config():
-    global logger
+    global logger, queue_handler
 
     if 'logger' not in globals():
         _init()
     else:
         config = _ConfigFile.getConfig()
         logger.setLevel(config.get('level'))
+        queue_handler.setLevel(config.get('level'))
+
+# Last parsed configuration and the file signature it was parsed from
+_cached = { 'sig': None, 'header': None, 'value': None }
 
 class _ConfigFile:
 
     @staticmethod
-    def _open(mode, yaml):
+    def _open():
         """
-        Open, parse, as yaml if flagged, and close file
+        Open, parse as yaml, and close file
         """
-        with open(DEFAULTS.get('CONFIG_FILE'), mode) as configFile:
-            if yaml is True:
-                return load(configFile)
-
-            return configFile.read()
+        with open(DEFAULTS.get('CONFIG_FILE'), 'r') as configFile:
+            return load(configFile, Loader=_Loader)
 
     @staticmethod
     def getConfig():
         """
-        Get configuration from yaml. Set default if we got
-        some problem while opening the file
+        Get configuration from yaml. The file is only parsed again
+        if its signature changed since the last call, and then only
+        if its content version header changed too or there is none
 
         Return an object { 'config': value, ... }
         """
+        configSig = _ConfigFile.signature()
+        if configSig is None or configSig != _cached['sig']:
+            header = _ConfigFile.header()
+            if header is None or header != _cached['header']:
+                _cached['value'], parsed = _ConfigFile._parse()
+
+                # Keep header only if the file parsed, so fixing it is not skipped
+                _cached['header'] = header if parsed else None
+
+            _cached['sig'] = configSig
+
+        return dict(_cached['value'])
+
+    @staticmethod
+    def header():
+        """
+        Read the '# content-version: <version>' first line of the file
+
+        Read as bytes, so a badly encoded file can not make it fail.
+        Return None if the file has no such header
+        """
+        try:
+            with open(DEFAULTS.get('CONFIG_FILE'), 'rb') as configFile:
+                line = configFile.readline()
+        except OSError:
+            return None
+
+        if not line.startswith(b'# content-version:'):
+            return None
+
+        return line.strip()
+
+    @staticmethod
+    def _parse():
+        """
+        Parse configuration from yaml. Set default if we got
+        some problem while opening the file
+
+        Return a tuple (config, parsed), parsed is False if default was set
+        """
+        parsed = True
         level = None
         formatter = None
         datefmt = None
         try:
-            config = _ConfigFile._open('r', yaml=True)
+            config = _ConfigFile._open()
             level = config['logging'].get('level')
             formatter = config['logging'].get('format')
             datefmt = config['logging'].get('datefmt')
-        except:
+        except (OSError, YAMLError, KeyError, TypeError, ValueError, AttributeError) as e:
+            parsed = False
+
+            # No handler may be set yet, logging falls back to stderr then
+            getLogger(DEFAULTS.get('LOGGER_NAME')).warning('config reload failed: %s', e)
+
             level = 'WARNING'
             formatter = '%(asctime)s %(levelname)s %(message)s'
             datefmt = '%Y-%m-%d %H:%M:%S'
 
-        return { 'level': level, 'formatter': formatter, 'datefmt': datefmt }
+        return { 'level': level, 'formatter': formatter, 'datefmt': datefmt }, parsed
 
     @staticmethod
-    def md5sum():
+    def signature():
         """
-        Open, close, read file and calculate MD5 on its contents
+        Stat file and return its (mtime, size, inode) signature
 
-        Used for checking if the configuration file changed
+        Used for checking if the configuration file changed without
+        reading it. It catches both in place edits and atomic replaces
         """
-        hashSum = None
         try:
-            # Open as read binary
-            config = _ConfigFile._open('rb', yaml=False)
-
-            # pipe contents of the file through
-            hashSum = md5(config).hexdigest()
-        except:
-            hashSum = 'none'
+            stats = stat(DEFAULTS.get('CONFIG_FILE'))
+        except OSError:
+            return None
 
-        return hashSum
+        return (stats.st_mtime_ns, stats.st_size, stats.st_ino)
 
 class _LoggerHandler(FileHandler):
     """
-    A handler class which inherits from FileHandler. Note that this class
-    does not changes how FileHandler emits records, it just add a check
-    for logger reconfiguration if config file has changed
+    A handler class which inherits from FileHandler. Records are written to
+    a buffered binary stream which is flushed DEFAULTS['FLUSH_INTERVAL'] secs
+    after the first unflushed write, or right away for records of level ERROR
+    and above so those are never lost. It also add a check for logger
+    reconfiguration if config file has changed. The check is done at most
+    once every DEFAULTS['CHECK_INTERVAL'] secs
     """
 
     def __init__(self, file):
         FileHandler.__init__(self, file)
-        self.configHash = _ConfigFile.md5sum()
+        self.configSig = _ConfigFile.signature()
+        self.nextCheck = monotonic() + DEFAULTS.get('CHECK_INTERVAL')
+
+        # Start flusher, it waits for unflushed writes
+        self.pending = Event()
+        flusher = Thread(target=self._flushLoop, daemon=True)
+        flusher.start()
+
+    def _open(self):
+        """
+        Open the log file as a buffered binary stream
+        """
+        return open(self.baseFilename, 'ab', buffering=DEFAULTS.get('BUFFER_SIZE'))
+
+    def _flushLoop(self):
+        """
+        Flush stream every time some write has been pending for
+        DEFAULTS['FLUSH_INTERVAL'] secs
+        """
+        while True:
+            self.pending.wait()
+            sleep(DEFAULTS.get('FLUSH_INTERVAL'))
+            self.pending.clear()
+            self.flush()
 
     def emit(self, record):
-        if self.configHash != _ConfigFile.md5sum():
-            _config()
-            self.configHash = _ConfigFile.md5sum()
+        now = monotonic()
+        if now >= self.nextCheck:
+            self.nextCheck = now + DEFAULTS.get('CHECK_INTERVAL')
+            configSig = _ConfigFile.signature()
+            if self.configSig != configSig:
+                self.configSig = configSig
+
+                # A bad config file must never stop logging
+                try:
+                    _config()
+                except Exception:
+                    self.handleError(record)
+
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+
+            self.stream.write((self.format(record) + self.terminator).encode('utf-8'))
+
+            if record.levelno >= ERROR:
+                self.stream.flush()
+            elif not self.pending.is_set():
+                self.pending.set()
+        except Exception:
+            self.handleError(record)
+
+class _QueueHandler(QueueHandler):
+    """
+    A handler class which inherits from QueueHandler. Records are appended
+    to a bounded deque and the listener is woken up through an Event, which
+    is only set if the listener is waiting for records. When the deque is full new
+    records are dropped, so that none already queued is overwritten, and a
+    warning with the amount dropped is queued as soon as there is room
+    again. Records are queued as they are, formatting is left to the
+    listener thread
+    """
+
+    def __init__(self, queue, event):
+        QueueHandler.__init__(self, queue)
+        self.event = event
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Queue is in-process, so the record does not need to be pickleable
+        """
+        return record
+
+    def enqueue(self, record):
+        queue = self.queue
+
+        if len(queue) == queue.maxlen:
+            self.dropped += 1
+            return
+
+        if self.dropped:
+            queue.append(makeLogRecord({
+                'name': record.name,
+                'levelno': WARNING,
+                'levelname': _levelToName[WARNING],
+                'msg': 'log queue full, dropped %s records',
+                'args': (self.dropped,)
+            }))
+            self.dropped = 0
+
+            if len(queue) == queue.maxlen:
+                self.dropped += 1
+                return
 
-        FileHandler.emit(self, record)
+        queue.append(record)
+
+        if not self.event.is_set():
+            self.event.set()
+
+class _QueueListener(QueueListener):
+    """
+    A listener class which inherits from QueueListener. It takes records
+    from the deque fed by _QueueHandler, waiting on their shared Event
+    only while the deque is empty
+    """
+
+    def __init__(self, queue, event, *handlers):
+        QueueListener.__init__(self, queue, *handlers)
+        self.event = event
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.popleft()
+            except IndexError:
+                if not block:
+                    raise Empty
+
+            # Records appended after clear() set the event again
+            self.event.wait()
+            self.event.clear()
+
+    def enqueue_sentinel(self):
+        self.queue.append(self._sentinel)
+        self.event.set()
 
 def _init():
     """
@@ -188,15 +365,16 @@ def _init():
     """
     _acquireLock()
     try:
-        global logger
+        global logger, queue_handler
 
         # do NOT initialize again
         if 'logger' in globals():
             return
 
         # Create QueueHandler
-        que = Queue(-1) # no limit on size
-        queue_handler = QueueHandler(que)
+        que = deque(maxlen=DEFAULTS.get('QUEUE_SIZE'))
+        event = Event()
+        queue_handler = _QueueHandler(que, event)
 
         # Get config parameters
         config = _ConfigFile.getConfig()
@@ -210,94 +388,37 @@ def _init():
         logger.addHandler(queue_handler)
         logger.setLevel(config.get('level'))
 
+        # Filter records from child loggers before they get queued
+        queue_handler.setLevel(config.get('level'))
+
         # Start listener
-        listener = QueueListener(que, handler)
+        listener = _QueueListener(que, event, handler)
         listener.start()
     finally:
         _releaseLock()
 
 #---------------------------------------------------------------------------
 # Utility functions at module level.
-# Basically delegate everything to the global logger from logging module.
+# Basically bound straight to the global logger from logging module, which is
+# initialized on import so that no log call has to check for it.
 #---------------------------------------------------------------------------
 
-def critical(msg, *args, **kwargs):
-    """
-    Log a message with severity 'CRITICAL' on the root logger. If the logger
-    has not be initialized yet, do it now.
-    """
-    global logger
-    if 'logger' not in globals():
-        _init()
-
-    logger.critical(msg, *args, **kwargs)
-
-def error(msg, *args, **kwargs):
-    """
-    Log a message with severity 'ERROR' on the root logger. If the logger
-    has not be initialized yet, do it now.
-    """
-    global logger
-    if 'logger' not in globals():
-        _init()
-
-    logger.error(msg, *args, **kwargs)
-
-def exception(msg, *args, exc_info=True, **kwargs):
-    """
-    Log a message with severity 'ERROR' on the root logger, with exception
-    information. If the logger has not be initialized yet, do it now.
-    """
-    global logger
-    if 'logger' not in globals():
-        _init()
-
-    logger.error(msg, *args, exc_info=exc_info, **kwargs)
-
-def warning(msg, *args, **kwargs):
-    """
-    Log a message with severity 'WARNING' on the root logger. If the logger has
-    not be initialized yet, do it now.
-    """
-    global logger
-    if 'logger' not in globals():
-        _init()
+_init()
 
-    logger.warning(msg, *args, **kwargs)
-
-def info(msg, *args, **kwargs):
-    """
-    Log a message with severity 'INFO' on the root logger. If the logger has
-    not be initialized yet, do it now.
-    """
-    global logger
-    if 'logger' not in globals():
-        _init()
-
-    logger.info(msg, *args, **kwargs)
-
-def debug(msg, *args, **kwargs):
-    """
-    Log a message with severity 'DEBUG' on the root logger. If the logger has
-    not be initialized yet, do it now.
-    """
-    global logger
-    if 'logger' not in globals():
-        _init()
-
-    logger.debug(msg, *args, **kwargs)
+critical = logger.critical
+error = logger.error
+exception = logger.exception
+warning = logger.warning
+info = logger.info
+debug = logger.debug
+isEnabledFor = logger.isEnabledFor
 
 def log(level, msg, *args, **kwargs):
     """
-    Log 'msg % args' with the integer severity 'level' on the root logger. If
-    the logger has not be initialized yet, do it now.
+    Log 'msg % args' with the integer severity 'level' on the root logger.
 
     Adds extra check for level argument.
     """
-    global logger
-    if 'logger' not in globals():
-        _init()
-
     if level not in _levelToName:
         level = WARNING
 
@@ -1,9 +1,15 @@
 # Python lib imports
-from yaml import load
-from time import sleep
-from hashlib import md5
+from os import stat
+from yaml import YAMLError, load
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+from time import time
+from threading import Event
+from collections import namedtuple
 from datetime import datetime, timezone
-from logging import getLogger, NullHandler
+from logging import DEBUG, INFO, getLogger, NullHandler
 
 # Raspberry lib
 import RPi.GPIO as GPIO
@@ -14,8 +20,12 @@ __all__ = [ 'run' ]
 
 # Log config file location
 # Change if need
+#
+# NOTE: If the config file starts with a '# content-version: <version>' line,
+# it is only parsed again when that version changes, so bump it on every edit
 DEFAULTS = {
     'CONFIG_FILE': 'watering/watering.yml',
+    'CONFIG_INTERVAL': 60 # max secs between config file checks while idle
 }
 
 
@@ -24,69 +34,140 @@ DEFAULTS = {
 # Intended to be 'private', change at your own risk :P
 #---------------------------------------------------------------------------
 
+# GPIO mode by its name on the config file, and the other way around
+_MODE_MAP = { 'BCM': GPIO.BCM, 'BOARD': GPIO.BOARD }
+_MODE_NAME = { GPIO.BCM: 'BCM', GPIO.BOARD: 'BOARD' }
+
+# Settings of the watering that is going on
+_Actual = namedtuple('_Actual', 'startHour pin timeOn')
+
+# Last parsed configuration and the file signature it was parsed from
+_cached = { 'sig': None, 'header': None, 'value': None }
+
 class _ConfigFile:
 
+    # Logger for config errors, run() sets the one it is given
+    logger = getLogger(__name__)
+
     @staticmethod
-    def _open(mode, yaml):
+    def _open():
         """
-        Open, parse, as yaml if flagged, and close file
+        Open, parse as yaml, and close file
         """
-        with open(DEFAULTS.get('CONFIG_FILE'), mode) as configFile:
-            if yaml is True:
-                return load(configFile)
-
-            return configFile.read()
+        with open(DEFAULTS.get('CONFIG_FILE'), 'r') as configFile:
+            return load(configFile, Loader=_Loader)
 
     @staticmethod
     def getConfig():
         """
-        Get configuration from yaml. Set default if we got
-        some problem while opening the file
+        Get configuration from yaml. The file is only parsed again
+        if its signature changed since the last call, and then only
+        if its content version header changed too or there is none
 
         Return an object { 'config': value, ... }
         """
+        configSig = _ConfigFile.signature()
+        if configSig is None or configSig != _cached['sig']:
+            header = _ConfigFile.header()
+            if header is None or header != _cached['header']:
+                _cached['value'], parsed = _ConfigFile._parse()
+
+                # Keep header only if the file parsed, so fixing it is not skipped
+                _cached['header'] = header if parsed else None
+
+            _cached['sig'] = configSig
+
+        return dict(_cached['value'])
+
+    @staticmethod
+    def header():
+        """
+        Read the '# content-version: <version>' first line of the file
+
+        Read as bytes, so a badly encoded file can not make it fail.
+        Return None if the file has no such header
+        """
+        try:
+            with open(DEFAULTS.get('CONFIG_FILE'), 'rb') as configFile:
+                line = configFile.readline()
+        except OSError:
+            return None
+
+        if not line.startswith(b'# content-version:'):
+            return None
+
+        return line.strip()
+
+    @staticmethod
+    def _parse():
+        """
+        Parse configuration from yaml. Set default if we got
+        some problem while opening the file
+
+        Return a tuple (config, parsed), parsed is False if default was set
+        """
+        parsed = True
         gpioMode = None
         watering = {}
         try:
-            config = _ConfigFile._open('r', yaml=True)
-            gpioMode = (GPIO.BCM, GPIO.BOARD)[config.get('gpioMode') == 'BOARD']
-            # Index watering config as { 'startHour': 'pin' }
-            for wateringTime in config.get('watering'):
-                watering[wateringTime.get('startHour')] = { 'pin': wateringTime.get('pin'), 'timeOn': wateringTime.get('timeOn') }
-        except Exception as e:
+            config = _ConfigFile._open()
+            gpioMode = _MODE_MAP.get(config.get('gpioMode'), GPIO.BOARD)
+            # Index watering config as { startHour: { 'pin', 'timeOn' } }
+            for wateringTime in config['watering']:
+                watering[int(wateringTime['startHour'])] = { 'pin': wateringTime['pin'], 'timeOn': wateringTime['timeOn'] }
+        except (OSError, YAMLError, KeyError, TypeError, ValueError, AttributeError) as e:
+            parsed = False
+
+            _ConfigFile.logger.warning('config reload failed: %s', e)
+
             gpioMode = GPIO.BOARD
              # Never reach
-            watering['-1'] = { 'pin': 8, 'timeOn': 3 }
+            watering[-1] = { 'pin': 8, 'timeOn': 3 }
 
-        return { 'gpioMode': gpioMode, 'watering': watering }
+        return { 'gpioMode': gpioMode, 'watering': watering, 'hours': frozenset(watering) }, parsed
 
     @staticmethod
-    def md5sum():
+    def signature():
         """
-        Open, close, read file and calculate MD5 on its contents
+        Stat file and return its (mtime, size, inode) signature
 
-        Used for checking if the configuration file changed
+        Used for checking if the configuration file changed without
+        reading it. It catches both in place edits and atomic replaces
         """
-        hashSum = None
         try:
-            # Open as read binary
-            config = _ConfigFile._open('rb', yaml=False)
-
-            # pipe contents of the file through
-            hashSum = md5(config).hexdigest()
-        except:
-            hashSum = 'none'
+            stats = stat(DEFAULTS.get('CONFIG_FILE'))
+        except OSError:
+            return None
 
-        return hashSum
+        return (stats.st_mtime_ns, stats.st_size, stats.st_ino)
 
 class _State:
 
     def __init__(self, name, logger):
         self.name = name
         self.logger = logger
+        self.levels()
+
+    def levels(self):
+        """
+        Cache which log levels are enabled, so disabled log calls
+        are skipped without going through the logger
+        """
+        self.logDebug = self.logger.isEnabledFor(DEBUG)
+        self.logInfo = self.logger.isEnabledFor(INFO)
 
     def construct(self, config):
-        self.logger.info('state: %s', self.name)
+        # Pick up level changes on every state change
+        self.levels()
+
+        if self.logInfo:
+            self.logger.info('state: %s', self.name)
+
+    def sleep(self, secs):
+        """
+        Sleep for secs, waking up early if the state machine is stopped
+        """
+        _Watering.stopEvent.wait(secs)
 
     def run(self, config):
         assert 0, "run not implemented"
@@ -100,7 +181,7 @@ class _StateMachine:
     def __init__(self, initialState):
         # Config file settings
         self.config = _ConfigFile.getConfig()
-        self.configHash = _ConfigFile.md5sum()
+        self.configSig = _ConfigFile.signature()
 
         # State settings
         self.oldState = ''
@@ -108,11 +189,18 @@ class _StateMachine:
         self.currentState.run(self.config)
 
     def runAll(self):
-        while True:
+        while not self.stopEvent.is_set():
             # Check if config file changed
-            if self.configHash != _ConfigFile.md5sum():
-                self.config = _ConfigFile.getConfig()
-                self.configHash = _ConfigFile.md5sum()
+            configSig = _ConfigFile.signature()
+            if self.configSig != configSig:
+                config = _ConfigFile.getConfig()
+
+                # Keep the watering that is going on, if any
+                if 'actual' in self.config:
+                    config['actual'] = self.config['actual']
+
+                self.config = config
+                self.configSig = configSig
 
             # Set next state
             self.currentState = self.currentState.next(self.config)
@@ -122,71 +210,76 @@ class _StateMachine:
                 self.currentState.construct(self.config)
                 self.oldState = self.currentState.name
 
-            # Run state
+            # Run state, each one sleeps on its own
             self.currentState.run(self.config)
 
-            # Sleep for 0.1 secs
-            sleep(0.1)
-
 
 class _Idle(_State):
 
-    def run(self, config):
-        sleep(1)
-
-    def next(self, config):
-        wateringDict = config.get('watering')
-        startHour = datetime.now(timezone.utc).hour
-
-        if startHour in wateringDict:
-            settings = wateringDict.get(startHour)
-            config['actual'] = { 'startHour': startHour, 'pin': settings.get('pin'), 'timeOn': settings.get('timeOn') }
-
-            self.logger.debug('actual config: %s', config['actual'])
-
-            return _Watering.initGPIO
-
-        return _Watering.idle
-
-
-class _InitGPIO(_State):
-
     def __init__(self, name, logger):
         # Generic init
         _State.__init__(self, name, logger)
 
         # Init variables
-        self.gpioMode = 0
-        self.pin = 0
+        self.config = None
+        self.wakeUp = 0
 
     def construct(self, config):
         # Do generic construct
         _State.construct(self, config)
 
-        # Fetch variables
-        self.gpioMode = config.get('gpioMode')
-        self.pin = (config.get('actual')).get('pin')
+        self.schedule(config)
+
+    def schedule(self, config):
+        """
+        Compute the epoch of the next watering start hour, which is
+        right now if we are already within one
+        """
+        self.config = config
+        now = datetime.now(timezone.utc)
 
-        self.logger.debug('gpioMode: %s', ('BCM', 'BOARD')[self.gpioMode == GPIO.BOARD])
-        self.logger.debug('pin: %s', self.pin)
+        # Hours from now until each start hour
+        hours = [ (startHour - now.hour) % 24 for startHour in config['hours'] if startHour in range(24) ]
+
+        if not hours:
+            self.wakeUp = float('inf')
+        elif min(hours) == 0:
+            self.wakeUp = 0
+        else:
+            self.wakeUp = now.replace(minute=0, second=0, microsecond=0).timestamp() + min(hours) * 3600
+
+        if self.logDebug:
+            self.logger.debug('hours until next start hour: %s', min(hours, default=None))
 
     def run(self, config):
-        # Check GPIO mode
-        if GPIO.getmode() != self.gpioMode:
-            self.logger.error('GPIO mode mismatch with the one on the configuration file')
-            return
+        if config is not self.config:
+            self.schedule(config)
 
-        # Setup GPIO pin
-        GPIO.setup(self.pin, GPIO.OUT)
-        sleep(1)
+        # Sleep until next start hour, waking up from time to time to check for config changes
+        self.sleep(min(self.wakeUp - time(), DEFAULTS.get('CONFIG_INTERVAL')))
 
     def next(self, config):
-        # Check if GPIO was initialized correctly
-        try:
-            GPIO.output(self.pin, 1)
+        if config is not self.config:
+            self.schedule(config)
+
+        if time() < self.wakeUp:
+            return _Watering.idle
+
+        startHour = datetime.now(timezone.utc).hour
+
+        if startHour in config['hours']:
+            settings = config['watering'][startHour]
+            config['actual'] = _Actual(startHour, settings['pin'], settings['timeOn'])
+
+            if self.logDebug:
+                self.logger.debug('actual config: %s', config['actual'])
+
             return _Watering.turnOn
-        except:
-            return _Watering.initGPIO
+
+        # Woke up out of a start hour (clock changed), try again
+        self.schedule(config)
+
+        return _Watering.idle
 
 
 class _TurnOn(_State):
@@ -199,6 +292,7 @@ class _TurnOn(_State):
         self.counter = 0
         self.pin = 0
         self.timeOn = 3
+        self.setupPin = None
 
     def construct(self, config):
         # Do generic construct
@@ -206,17 +300,22 @@ class _TurnOn(_State):
 
         # Fetch variables
         self.counter = 0
-        self.pin = (config.get('actual')).get('pin')
-        self.timeOn = (config.get('actual')).get('timeOn')
+        self.pin = config['actual'].pin
+        self.timeOn = config['actual'].timeOn
+
+        if self.logDebug:
+            self.logger.debug('pin: %s, timeOn: %s', self.pin, self.timeOn)
 
-        self.logger.debug('pin: %s', self.pin)
-        self.logger.debug('timeOn: %s', self.timeOn)
+        # Setup GPIO pin, skip it if already done on a previous watering
+        if self.pin != self.setupPin:
+            GPIO.setup(self.pin, GPIO.OUT)
+            self.setupPin = self.pin
 
     def run(self, config):
         GPIO.output(self.pin, 1)
-        sleep(1)
+        self.sleep(1)
         GPIO.output(self.pin, 0)
-        sleep(60)
+        self.sleep(60)
         self.counter = self.counter + 1
 
     def next(self, config):
@@ -240,20 +339,21 @@ class _TurnOff(_State):
         _State.construct(self, config)
 
         # Fetch variables
-        self.pin = (config.get('actual')).get('pin')
+        self.pin = config['actual'].pin
 
-        self.logger.debug('pin: %s', self.pin)
+        if self.logDebug:
+            self.logger.debug('pin: %s', self.pin)
 
     def run(self, config):
         GPIO.output(self.pin, 0)
-        sleep(1)
+        self.sleep(1)
 
     def next(self, config):
         # Release PIN
         try:
             GPIO.output(self.pin, 1)
             return _Watering.waiting
-        except:
+        except (RuntimeError, ValueError):
             return _Watering.turnOff
 
 
@@ -265,41 +365,67 @@ class _Waiting(_State):
 
         # Set variables default
         self.startHour = None
+        self.wakeUp = 0
 
     def construct(self, config):
         # Do generic construct
         _State.construct(self, config)
 
         # Fetch variables
-        self.startHour = (config.get('actual')).get('startHour')
+        self.startHour = config['actual'].startHour
+
+        # Wait until start hour is over
+        now = datetime.now(timezone.utc)
+        if self.startHour != now.hour:
+            self.wakeUp = 0
+        else:
+            self.wakeUp = now.replace(minute=0, second=0, microsecond=0).timestamp() + 3600
 
-        self.logger.debug('startHour: %s', self.startHour)
+        if self.logDebug:
+            self.logger.debug('startHour: %s', self.startHour)
 
     def run(self, config):
-        sleep(1)
+        # Sleep until start hour is over, waking up from time to time in case the clock changed
+        self.sleep(min(self.wakeUp - time(), DEFAULTS.get('CONFIG_INTERVAL')))
 
     def next(self, config):
-        if self.startHour != datetime.now(timezone.utc).hour:
-                return _Watering.idle
+        if time() >= self.wakeUp or self.startHour != datetime.now(timezone.utc).hour:
+            return _Watering.idle
 
         return _Watering.waiting
 
 
 class _Watering(_StateMachine):
 
+    stopEvent = Event()
+
     def __init__(self):
         _StateMachine.__init__(self, _Watering.idle)
 
 
-def run(logger=None):
+def run(logger=None, stopEvent=None):
 
     # Add null logger handler if None
     if logger is None:
-        logger = getLogger('NullHandlerLogger').addHandler(NullHandler())
+        logger = getLogger('NullHandlerLogger')
+        logger.addHandler(NullHandler())
+
+    # Run until stopEvent is set, forever if None
+    if stopEvent is not None:
+        _Watering.stopEvent = stopEvent
+
+    _ConfigFile.logger = logger
 
     try:
+        # Check GPIO mode once, pins are setup with it from now on
+        gpioMode = _ConfigFile.getConfig()['gpioMode']
+        logger.debug('gpioMode: %s', _MODE_NAME[gpioMode])
+
+        if GPIO.getmode() != gpioMode:
+            logger.error('GPIO mode mismatch with the one on the configuration file')
+            return
+
         _Watering.idle = _Idle('Idle', logger)
-        _Watering.initGPIO = _InitGPIO('InitGPIO', logger)
         _Watering.turnOn = _TurnOn('TurnOn', logger)
         _Watering.turnOff = _TurnOff('TurnOff', logger)
         _Watering.waiting = _Waiting('Waiting', logger)